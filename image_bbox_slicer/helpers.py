@@ -2,19 +2,58 @@
 Helper functions for ``image_bbox_slicer``.
 """
 import os
-import glob
+import csv
 import warnings
 import numpy as np
 from PIL import Image
 from enum import Enum
-from itertools import compress
+from collections import namedtuple, Counter
+from functools import lru_cache
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
-import xml.etree.ElementTree as ET
+from matplotlib.collections import PatchCollection
+from matplotlib.image import pil_to_array
+try:
+    from lxml import etree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
 from math import sqrt, ceil, floor
 
 
 IMG_FORMAT_LIST = ['jpg', 'jpeg', 'png', 'tiff', 'exif', 'bmp']
+_IMG_FORMAT_SET = frozenset(IMG_FORMAT_LIST)
+
+# Info extracted from a PASCAL VOC file by `extract_from_xml`
+VOCAnnotation = namedtuple('VOCAnnotation', ['filename', 'width', 'height', 'objects', 'boxes'])
+
+# Same layout as the PASCAL VOC files written by `pascal-voc-writer`
+VOC_HEADER_TEMPLATE = '''<annotation>
+    <folder>{folder}</folder>
+    <filename>{filename}</filename>
+    <path>{path}</path>
+    <source>
+        <database>Unknown</database>
+    </source>
+    <size>
+        <width>{width}</width>
+        <height>{height}</height>
+        <depth>3</depth>
+    </size>
+    <segmented>0</segmented>
+'''
+VOC_OBJECT_TEMPLATE = '''    <object>
+        <name>{}</name>
+        <pose>{}</pose>
+        <truncated>{}</truncated>
+        <difficult>{}</difficult>
+        <bndbox>
+            <xmin>{}</xmin>
+            <ymin>{}</ymin>
+            <xmax>{}</xmax>
+            <ymax>{}</ymax>
+        </bndbox>
+    </object>'''
 
 # Source : Sam Dobson
 # https://github.com/samdobson/image_slicer
@@ -39,6 +78,138 @@ def calc_columns_rows(n):
     return (num_columns, num_rows)
 
 
+def get_tiles(img_size, tile_size, tile_overlap):
+    """Generates coordinates of all the tiles of an image.
+
+    Does not validate its arguments, see `validate_tile_size` and `validate_overlap`.
+
+    Parameters
+    ----------
+    img_size : tuple
+        Size of the original image in pixels, as a 2-tuple: (width, height).
+    tile_size : tuple
+        Size of each tile in pixels, as a 2-tuple: (width, height).
+    tile_overlap: float
+        Percentage of tile overlap between two consecutive strides.
+
+    Returns
+    ----------
+    ndarray
+        A read-only `(T, 4)` array.
+        Each row holding coordinates of a possible tile
+        in the format - `(xmin, ymin, xmax, ymax)`
+    """
+    img_w, img_h = img_size
+    tile_w, tile_h = tile_size
+    stride_w = int((1 - tile_overlap) * tile_w)
+    stride_h = int((1 - tile_overlap) * tile_h)
+    return _tile_coords(img_w, img_h, tile_w, tile_h, stride_w, stride_h)
+
+
+@lru_cache(maxsize=32)
+def _tile_coords(img_w, img_h, tile_w, tile_h, stride_w, stride_h):
+    """Cached worker of `get_tiles`, images in a dataset mostly share the same size.
+    """
+    xs = np.arange(0, img_w-tile_w+1, stride_w, dtype=np.int32)
+    ys = np.arange(0, img_h-tile_h+1, stride_h, dtype=np.int32)
+    x1, y1 = np.meshgrid(xs, ys)
+    x1, y1 = x1.ravel(), y1.ravel()
+    tiles = np.stack([x1, y1, x1 + tile_w, y1 + tile_h], axis=1)
+    # The same array is handed out to every caller
+    tiles.setflags(write=False)
+    return tiles
+
+
+def find_tile_overlaps(img_size, tile_size, tile_overlap, boxes):
+    """Finds which tiles from `get_tiles` each bounding box overlaps.
+
+    The tiles form a regular grid, so the rows and columns of tiles a box can overlap
+    follow from its coordinates and the strides without checking every tile.
+
+    Parameters
+    ----------
+    img_size : tuple
+        Size of the original image in pixels, as a 2-tuple: (width, height).
+    tile_size : tuple
+        Size of each tile in pixels, as a 2-tuple: (width, height).
+    tile_overlap: float
+        Percentage of tile overlap between two consecutive strides.
+    boxes : ndarray
+        Bounding box coordinates as a `(N, 4)` array of `(xmin, ymin, xmax, ymax)` rows.
+
+    Returns
+    ----------
+    ndarray, ndarray
+        Indices of tiles and of the boxes overlapping them, as two 1-D arrays of the same length.
+        Sorted by tile index and then by box index.
+    """
+    img_w, img_h = img_size
+    tile_w, tile_h = tile_size
+    stride_w = int((1 - tile_overlap) * tile_w)
+    stride_h = int((1 - tile_overlap) * tile_h)
+    n_cols = (img_w - tile_w) // stride_w + 1
+    n_rows = (img_h - tile_h) // stride_h + 1
+    boxes = np.asarray(boxes, dtype=np.int64).reshape(-1, 4)
+
+    # Tile `c` spans [c * stride, c * stride + tile), which overlaps a box when
+    # c * stride < box_max and c * stride + tile > box_min
+    col_lo = np.maximum((boxes[:, 0] - tile_w) // stride_w + 1, 0)
+    col_hi = np.minimum((boxes[:, 2] - 1) // stride_w, n_cols - 1)
+    row_lo = np.maximum((boxes[:, 1] - tile_h) // stride_h + 1, 0)
+    row_hi = np.minimum((boxes[:, 3] - 1) // stride_h, n_rows - 1)
+    n_box_cols = np.maximum(col_hi - col_lo + 1, 0)
+    n_box_rows = np.maximum(row_hi - row_lo + 1, 0)
+    counts = n_box_cols * n_box_rows
+
+    # Enumerate the (row, col) cells of every box in one go
+    box_idx = np.repeat(np.arange(len(boxes)), counts)
+    local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    n_box_cols = n_box_cols[box_idx]
+    rows = row_lo[box_idx] + local // np.maximum(n_box_cols, 1)
+    cols = col_lo[box_idx] + local % np.maximum(n_box_cols, 1)
+    tile_idx = rows * n_cols + cols
+
+    order = np.argsort(tile_idx, kind='stable')
+    return tile_idx[order], box_idx[order]
+
+
+def clip_boxes(tiles, boxes, keep_partial_labels=False):
+    """Clips bounding boxes against tiles.
+
+    `tiles` and `boxes` are broadcast against each other,
+    e.g. `clip_boxes(tiles[:, None], boxes[None])` clips every box against every tile
+    while `clip_boxes(tiles[tile_idx], boxes[box_idx])` clips only the given pairs.
+
+    Parameters
+    ----------
+    tiles : ndarray
+        Tile coordinates as an array of `(xmin, ymin, xmax, ymax)` rows, shaped `(..., 4)`.
+    boxes : ndarray
+        Bounding box coordinates as an array of `(xmin, ymin, xmax, ymax)` rows, shaped `(..., 4)`.
+    keep_partial_labels : bool, optional
+        Default value is `False`.
+        Flag to denote if boxes that lie only partly in a tile should be kept.
+
+    Returns
+    ----------
+    ndarray, ndarray
+        The first is a `(..., 4)` array of the boxes clipped to the tiles,
+        in the coordinates of the tiles.
+        The second is a `(...)` boolean array marking the boxes that should be kept.
+    """
+    tx1, ty1, tx2, ty2 = tiles[..., 0], tiles[..., 1], tiles[..., 2], tiles[..., 3]
+    bx1, by1, bx2, by2 = boxes[..., 0], boxes[..., 1], boxes[..., 2], boxes[..., 3]
+    ix1, iy1 = np.maximum(tx1, bx1), np.maximum(ty1, by1)
+    ix2, iy2 = np.minimum(tx2, bx2), np.minimum(ty2, by2)
+
+    # A clipped box with no width or height is never worth writing out
+    keep = (ix2 > ix1) & (iy2 > iy1)
+    if not keep_partial_labels:
+        keep &= (bx1 >= tx1) & (by1 >= ty1) & (bx2 <= tx2) & (by2 <= ty2)
+    clipped = np.stack([ix1 - tx1, iy1 - ty1, ix2 - tx1, iy2 - ty1], axis=-1)
+    return clipped, keep
+
+
 def validate_number_tiles(number_tiles):
     """Validates the sanity of the number of tiles asked for.
 
@@ -115,6 +286,46 @@ def validate_dir(dir_path, src=True):
             os.makedirs(dir_path, exist_ok=True)
 
 
+def list_files(dir_path, formats):
+    """Lists the files of given formats in a directory, sorted by file name.
+
+    Hidden files (starting with a `.`) are skipped, as `glob` does.
+
+    Parameters
+    ----------
+    dir_path : str
+        path/to/directory
+    formats : set or list
+        Lowercase file extensions to look for, without the leading `.`.
+
+    Returns
+    ----------
+    list
+        Paths to the files.
+    """
+    entries = [entry for entry in os.scandir(dir_path)
+               if not entry.name.startswith('.') and
+               os.path.splitext(entry.name)[1][1:].lower() in formats and entry.is_file()]
+    entries.sort(key=lambda entry: entry.name)
+    return [entry.path for entry in entries]
+
+
+def list_images(dir_path):
+    """Lists the images (of formats in `IMG_FORMAT_LIST`) in a directory, sorted by file name.
+
+    Parameters
+    ----------
+    dir_path : str
+        path/to/directory
+
+    Returns
+    ----------
+    list
+        Paths to the images.
+    """
+    return list_files(dir_path, _IMG_FORMAT_SET)
+
+
 def validate_file_names(img_src, ann_src):
     """Validates if image and annotation source directories have corresponding and matching file names.
 
@@ -134,21 +345,29 @@ def validate_file_names(img_src, ann_src):
     Exception
         If `img_src` and `ann_src` do not have matching image and annotation file names respectively.
     """
-    imgs = sorted(glob.glob(img_src + os.sep + '*'))
-    anns = sorted(glob.glob(ann_src + os.sep + '*.xml'))
-
-    imgs_filter = [True if x.split(
-        '.')[-1].lower() in IMG_FORMAT_LIST else False for x in imgs]
-    imgs = list(compress(imgs, imgs_filter))
-
-
-
-    imgs = [os.path.splitext(x.split(os.sep)[-1])[0] for x in imgs]
-    anns = [os.path.splitext(x.split(os.sep)[-1])[0] for x in anns]
+    imgs = [os.path.splitext(os.path.basename(x))[0] for x in list_images(img_src)]
+    anns = [os.path.splitext(os.path.basename(x))[0] for x in list_files(ann_src, ('xml',))]
 
     if not (imgs == anns):
+        # Sets only serve the error message, files are paired in order so duplicates matter too
+        missing_anns = sorted(set(imgs) - set(anns))
+        missing_imgs = sorted(set(anns) - set(imgs))
+        shared = sorted(name for name, count in Counter(imgs).items() if count > 1)
         raise Exception(
-            'Each image in `{}` must have its corresponding XML file in `{}` with the same file name.'.format(img_src, ann_src))
+            'Each image in `{}` must have its corresponding XML file in `{}` with the same file name. '
+            'Images without annotations: {}. Annotations without images: {}. '
+            'Images sharing a file name: {}.'.format(
+                img_src, ann_src, _preview(missing_anns), _preview(missing_imgs), _preview(shared)))
+
+
+def _preview(names, limit=10):
+    """Formats the first few of `names` for an error message.
+    """
+    if not names:
+        return 'none'
+    if len(names) > limit:
+        return '{} and {} more'.format(', '.join(names[:limit]), len(names) - limit)
+    return ', '.join(names)
 
 
 def validate_overlap(tile_overlap):
@@ -277,16 +496,21 @@ def save_before_after_map_csv(mapper, path):
     ----------
     None
     """
-    with open('{}{}mapper.csv'.format(path, os.sep), 'w') as f:
-        f.write("old_name,new_names\n")
-        for key in mapper.keys():
-            f.write("%s,%s\n" % (key, ','.join(mapper[key])))
+    with open('{}{}mapper.csv'.format(path, os.sep), 'w', newline='', buffering=1 << 20) as f:
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(['old_name', 'new_names'])
+        writer.writerows([key] + value for key, value in mapper.items())
     print('Successfully saved the mapping between files before and after slicing at {}'.format(path))
 
 
 def extract_from_xml(file):
     """Extracts useful info (classes, bounding boxes, filename etc.) from annotation (XML) file.
 
+    The file is streamed with `iterparse` and every `<object>` element is cleared
+    once its info is extracted, so memory use doesn't grow with the number of objects.
+    Size and filename are picked up on the way, no tree is kept around.
+    Uses `lxml` when it is installed.
+
     Parameters
     ----------
     file : str
@@ -294,49 +518,106 @@ def extract_from_xml(file):
 
     Returns
     ----------
-    Element, list
-        Element is the root of the XML tree.
-        list contains info of annotations (objects) in the file.
+    VOCAnnotation
+        A namedtuple with fields
+        `filename` - name of the image file the annotations belong to.
+        `width`, `height` - size of the image in pixels.
+        `objects` - info of annotations (objects) in the file as `(name, pose, truncated, difficult)` tuples.
+        `boxes` - their bounding boxes as a `(N, 4)` array of `(xmin, ymin, xmax, ymax)` rows.
     """
+    filename = None
+    width, height = 0, 0
     objects = []
-    tree = ET.parse(file)
-    root = tree.getroot()
-    for obj in root.findall('object'):
-        name = obj.find('name').text
-        pose = 'Unknown'
-        truncated = '0'
-        difficult = '0'
-        if obj.find('pose') is not None:
-            pose = obj.find('pose').text
-            
-        if obj.find('truncated') is not None:
-            truncated = obj.find('truncated').text
-
-        if obj.find('difficult') is not None:
-            difficult = obj.find('difficult').text
-
-        bbox = obj.find('bndbox')
-        xmin, ymin, xmax, ymax = 0, 0, 0, 0
-        for point in bbox:
-            if point.tag == 'xmin':
-                xmin = point.text
-            elif point.tag == 'ymin':
-                ymin = point.text
-            elif point.tag == 'xmax':
-                xmax = point.text
-            elif point.tag == 'ymax':
-                ymax = point.text
-        value = (name,
-                 pose,
-                 int(truncated),
-                 int(difficult),
-                 int(xmin.split('.')[0]),
-                 int(ymin.split('.')[0]),
-                 int(xmax.split('.')[0]),
-                 int(ymax.split('.')[0])
-                 )
-        objects.append(value)
-    return root, objects
+    coords = []
+    for _, elem in ET.iterparse(file):
+        if elem.tag == 'filename':
+            filename = elem.text
+            continue
+        elif elem.tag == 'size':
+            width = int(elem.find('width').text)
+            height = int(elem.find('height').text)
+            continue
+        elif elem.tag != 'object':
+            continue
+        obj = elem
+        # Looking fields up in a dict is cheaper than a `find` per field,
+        # reversed so the first of repeated fields wins as with `find`
+        fields = {child.tag: child.text for child in reversed(obj)}
+        bbox = {child.tag: child.text for child in reversed(obj.find('bndbox'))}
+        # Empty elements such as `<pose/>` have no text, they get the defaults too
+        objects.append((fields['name'] or '',
+                        fields.get('pose') or 'Unknown',
+                        int(fields.get('truncated') or '0'),
+                        int(fields.get('difficult') or '0')))
+        # Some tools write coordinates as floats, they are truncated to whole pixels
+        coords.extend((int(float(bbox['xmin'])),
+                       int(float(bbox['ymin'])),
+                       int(float(bbox['xmax'])),
+                       int(float(bbox['ymax']))))
+        obj.clear()
+    boxes = np.array(coords, dtype=np.int32).reshape(-1, 4)
+    return VOCAnnotation(filename, width, height, objects, boxes)
+
+
+def make_voc_header(img_dir, img_size):
+    """Renders the header of PASCAL VOC files for images of a given size in a directory.
+
+    Parameters
+    ----------
+    img_dir : str
+        /path/to/image/directory
+    img_size : tuple
+        Size of the images in pixels, as a 2-tuple: (width, height).
+
+    Returns
+    ----------
+    tuple
+        The header as a 3-tuple of strings, to be joined with the
+        escaped image file name and path in between them.
+    """
+    # NUL can't be part of XML text, so it safely marks where the name and path go
+    header = VOC_HEADER_TEMPLATE.format(folder=escape(os.path.basename(os.path.abspath(img_dir))),
+                                        filename='\0',
+                                        path='\0',
+                                        width=img_size[0],
+                                        height=img_size[1])
+    return tuple(header.split('\0'))
+
+
+def save_voc_xml(file, img_path, img_size, objects, boxes, header=None):
+    """Saves bounding box annotations of an image in a PASCAL VOC (XML) file.
+
+    Parameters
+    ----------
+    file : str
+        /path/to/xml/file.
+    img_path : str
+        /path/to/image/file the annotations belong to.
+    img_size : tuple
+        Size of the image in pixels, as a 2-tuple: (width, height).
+    objects : list
+        Info of annotations (objects) as `(name, pose, truncated, difficult)` tuples.
+    boxes : list or ndarray
+        Bounding boxes of the objects as `(xmin, ymin, xmax, ymax)` rows.
+    header : tuple, optional
+        Header from `make_voc_header`, worth reusing when saving many files
+        for images of the same size in the same directory.
+        By default, it is rendered from `img_path` and `img_size`.
+
+    Returns
+    ----------
+    None
+    """
+    img_path = os.path.abspath(img_path)
+    if header is None:
+        header = make_voc_header(os.path.dirname(img_path), img_size)
+    content = header[0] + escape(os.path.basename(img_path)) + header[1] + escape(img_path) + header[2]
+    content += ''.join(VOC_OBJECT_TEMPLATE.format(escape(obj[0] or ''), escape(obj[1] or ''), obj[2], obj[3], *box)
+                       for obj, box in zip(objects, boxes))
+    content += '\n</annotation>\n'
+    # XML without a declaration is UTF-8, whatever the locale encoding is
+    with open(file, 'wb') as f:
+        f.write(content.encode('utf-8'))
 
 
 def plot_image_boxes(img_path, ann_path, file_name):
@@ -364,60 +645,106 @@ def plot_image_boxes(img_path, ann_path, file_name):
     # Checking if the file is a source image as the data type
     # Source image - string, tile images - list of strings
     if isinstance(file_name, str):
-        tree = ET.parse(ann_path + os.sep + file_name + '.xml')
-        root = tree.getroot()
-
-        im = Image.open(img_path + os.sep + file_name + '.jpg')
-        im = np.array(im, dtype=np.uint8)
-
-        rois = []
-        for member in root.findall('object'):
-            rois.append((int(member[4][0].text), int(member[4][1].text),
-                         int(member[4][2].text), int(member[4][3].text)))
-
         # Create figure and axes
         fig, ax = plt.subplots(1, figsize=(10, 10))
-
-        # Display the image
-        ax.imshow(im)
-
-        for roi in rois:
-            # Create a Rectangle patch
-            rect = patches.Rectangle((roi[0], roi[1]), roi[2]-roi[0], roi[3]-roi[1],
-                                     linewidth=3, edgecolor='b', facecolor='none')
-
-            # Add the patch to the Axes
-            ax.add_patch(rect)
+        _plot_on_axes(ax, img_path + os.sep + file_name + '.jpg',
+                      _load_rois(ann_path + os.sep + file_name + '.xml'))
     else:
         cols, rows = calc_columns_rows(len(file_name))
-        pos = []
-        for i in range(0, rows):
-            for j in range(0, cols):
-                pos.append((i, j))
+        # `squeeze=False` keeps `ax` 2-D even with a single row or column of tiles
         fig, ax = plt.subplots(rows, cols, sharex='col',
-                               sharey='row', figsize=(10, 7))
+                               sharey='row', figsize=(10, 7), squeeze=False)
         for idx, file in enumerate(file_name):
+            # Display the image at the right position
+            _plot_on_axes(ax[idx // cols, idx % cols], img_path + os.sep + file + '.jpg',
+                          _load_rois(ann_path + os.sep + file + '.xml'))
+    plt.show()
 
-            tree = ET.parse(ann_path + os.sep + file + '.xml')
-            root = tree.getroot()
 
-            im = Image.open(img_path + os.sep + file + '.jpg')
-            im = np.array(im, dtype=np.uint8)
+def _plot_on_axes(ax, img_file, rois, max_size=(1024, 1024)):
+    """Displays an image and its bounding boxes on a `matplotlib` axes.
 
-            rois = []
-            for member in root.findall('object'):
-                rois.append((int(member[4][0].text), int(member[4][1].text),
-                             int(member[4][2].text), int(member[4][3].text)))
+    Parameters
+    ----------
+    ax : matplotlib.axes.Axes
+        Axes to plot on.
+    img_file : str
+        /path/to/image/file
+    rois : list
+        Bounding boxes as `(xmin, ymin, xmax, ymax)` tuples.
+    max_size : tuple, optional
+        Size in pixels, as a 2-tuple: (width, height), the image only needs to be displayed at.
+        Default value is `(1024, 1024)`.
 
-            # Display the image at the right position
-            print(pos[idx][0], pos[idx][1])
-            ax[pos[idx][0], pos[idx][1]].imshow(im)
+    Returns
+    ----------
+    None
+    """
+    arr, (img_w, img_h) = _load_image(img_file, max_size)
+    # The extent keeps the axes in the pixel coordinates of the full image, as boxes are.
+    # Skip matplotlib's antialiasing pass, the image is already about display size
+    ax.imshow(arr, extent=(0, img_w, img_h, 0), interpolation='none')
 
-            for roi in rois:
-                # Create a Rectangle patch
-                rect = patches.Rectangle((roi[0], roi[1]), roi[2]-roi[0], roi[3]-roi[1],
-                                         linewidth=3, edgecolor='b', facecolor='none')
+    # Add all the boxes to the Axes as a single collection
+    rects = [patches.Rectangle((roi[0], roi[1]), roi[2]-roi[0], roi[3]-roi[1]) for roi in rois]
+    ax.add_collection(PatchCollection(rects, linewidth=3, edgecolor='b', facecolor='none'))
 
-                # Add the patch to the Axes
-                ax[pos[idx][0], pos[idx][1]].add_patch(rect)
-    plt.show()
+
+def _load_rois(xml_file):
+    """Reads the bounding boxes of a PASCAL VOC file, reusing earlier reads while the file is unchanged.
+
+    Parameters
+    ----------
+    xml_file : str
+        /path/to/xml/file
+
+    Returns
+    ----------
+    tuple
+        Bounding boxes as `(xmin, ymin, xmax, ymax)` tuples.
+    """
+    # Slicing again rewrites files under the same names, so the cache is keyed on their state too
+    stat = os.stat(xml_file)
+    return _read_rois(xml_file, stat.st_mtime_ns, stat.st_size)
+
+
+@lru_cache(maxsize=1024)
+def _read_rois(xml_file, mtime_ns, size):
+    """Cached worker of `_load_rois`.
+    """
+    return tuple(map(tuple, extract_from_xml(xml_file).boxes.tolist()))
+
+
+def _load_image(img_file, max_size):
+    """Reads an image for display, reusing earlier reads while the file is unchanged.
+
+    Parameters
+    ----------
+    img_file : str
+        /path/to/image/file
+    max_size : tuple
+        Size in pixels, as a 2-tuple: (width, height), the image only needs to be displayed at.
+
+    Returns
+    ----------
+    ndarray, tuple
+        ndarray holds the pixels shrunk to fit in `max_size`, read-only as it is shared between calls.
+        tuple is the size of the full image in pixels, as a 2-tuple: (width, height).
+    """
+    stat = os.stat(img_file)
+    return _read_image(img_file, stat.st_mtime_ns, stat.st_size, max_size)
+
+
+@lru_cache(maxsize=16)
+def _read_image(img_file, mtime_ns, size, max_size):
+    """Cached worker of `_load_image`.
+    """
+    with Image.open(img_file) as im:
+        img_size = im.size
+        # Only the displayed pixels are cached. JPEGs are decoded straight at a reduced
+        # scale, other formats are shrunk after decoding. Axes extents keep boxes in place.
+        im.thumbnail(max_size)
+        # Converts modes `imshow` can't display as it does for PIL images
+        arr = pil_to_array(im)
+    arr.setflags(write=False)
+    return arr, img_size
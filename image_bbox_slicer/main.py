@@ -3,12 +3,19 @@ Main functionality of ``image_bbox_slicer``.
 """
 import os
 import csv
-import glob
+import warnings
 import random
+import numpy as np
+from collections import deque
+from itertools import zip_longest
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from PIL import Image
-from pascal_voc_writer import Writer
 from image_bbox_slicer.helpers import *
 
+# Number of threads each worker uses to save tiles
+SAVE_THREADS = 4
+
+
 class Slicer(object):
     """
     Slicer class.
@@ -39,6 +46,17 @@ class Slicer(object):
         A boolean flag to denote if tiles with no labels post-slicing
         should be ignored or not.
         Default value is `True`.
+    n_workers : int
+        Number of workers used to slice images (processes) and to resize them (threads).
+        Setting it to `1` slices and resizes the images in the current thread.
+        Default value is the number of CPUs in the system.
+        On Windows and macOS, worker processes import the main script again, so scripts
+        slicing with more than one worker must call the slicer under `if __name__ == '__main__':`.
+    png_compress_level : int
+        ZLIB compression level, between `0` and `9`, of the PNG images saved when slicing or resizing.
+        Lower levels save faster but produce bigger files,
+        e.g. `1` typically saves several times faster than the default for a larger file.
+        Default value is `6`, same as Pillow.
     """
 
     def __init__(self):
@@ -58,8 +76,8 @@ class Slicer(object):
         self.keep_partial_labels = False
         self.save_before_after_map = False
         self.ignore_empty_tiles = True
-        self._ignore_tiles = []
-        self._just_image_call = True
+        self.n_workers = os.cpu_count()
+        self.png_compress_level = 6
 
     def config_dirs(self, img_src, ann_src,
                     img_dst=os.path.join(os.getcwd(), 'sliced_images'),
@@ -94,7 +112,7 @@ class Slicer(object):
         self.ANN_DST = ann_dst
 
     def __get_tiles(self, img_size, tile_size, tile_overlap):
-        """Generates a list coordinates of all the tiles after validating the values. 
+        """Generates coordinates of all the tiles after validating the values. 
         Private Method.
 
         Parameters
@@ -108,23 +126,43 @@ class Slicer(object):
 
         Returns
         ----------
-        list
-            A list of tuples.
-            Each holding coordinates of possible tiles 
+        ndarray
+            A read-only `(T, 4)` array.
+            Each row holding coordinates of a possible tile 
             in the format - `(xmin, ymin, xmax, ymax)` 
         """
         validate_tile_size(tile_size, img_size)
-        tiles = []
-        img_w, img_h = img_size
-        tile_w, tile_h = tile_size
-        stride_w = int((1 - tile_overlap) * tile_w)
-        stride_h = int((1 - tile_overlap) * tile_h)
-        for y in range(0, img_h-tile_h+1, stride_h):
-            for x in range(0, img_w-tile_w+1, stride_w):
-                x2 = x + tile_w
-                y2 = y + tile_h
-                tiles.append((x, y, x2, y2))
-        return tiles
+        return get_tiles(img_size, tile_size, tile_overlap)
+
+    def __tile_params(self, img_size, tile_size, tile_overlap, number_tiles):
+        """Returns the tile size and overlap to slice an image of size `img_size` with.
+        Private Method.
+
+        Parameters
+        ----------
+        img_size : tuple
+            Size of the original image in pixels, as a 2-tuple: (width, height).
+        tile_size : tuple
+            Size of each tile in pixels, as a 2-tuple: (width, height).
+            Ignored when `number_tiles` is positive.
+        tile_overlap: float
+            Percentage of tile overlap between two consecutive strides.
+            Ignored when `number_tiles` is positive.
+        number_tiles : int
+            The number of tiles an image needs to be sliced into, `-1` to slice by size.
+
+        Returns
+        ----------
+        tuple, float
+            tuple is the size of each tile of this image.
+            float is the overlap between its tiles.
+        """
+        if number_tiles > 0:
+            n_cols, n_rows = calc_columns_rows(number_tiles)
+            tile_w = int(floor(img_size[0] / n_cols))
+            tile_h = int(floor(img_size[1] / n_rows))
+            return (tile_w, tile_h), 0.0
+        return tile_size, tile_overlap
 
     def slice_by_size(self, tile_size, tile_overlap=0.0):
         """Slices both images and box annotations in source directories by specified size and overlap.
@@ -141,11 +179,12 @@ class Slicer(object):
         ----------
         None
         """
-        self._just_image_call = False
-        self.slice_bboxes_by_size(tile_size, tile_overlap)
-        self.slice_images_by_size(tile_size, tile_overlap)
-        self._ignore_tiles = []
-        self._just_image_call = True
+        validate_tile_size(tile_size)
+        validate_overlap(tile_overlap)
+        img_mapper, ann_mapper = self.__slice_both(tile_size, tile_overlap, number_tiles=-1)
+        if self.save_before_after_map:
+            save_before_after_map_csv(ann_mapper, self.ANN_DST)
+            save_before_after_map_csv(img_mapper, self.IMG_DST)
 
     def slice_by_number(self, number_tiles):
         """Slices both images and box annotations in source directories into specified number of tiles.
@@ -159,11 +198,41 @@ class Slicer(object):
         ----------
         None
         """
-        self._just_image_call = False
-        self.slice_bboxes_by_number(number_tiles)
-        self.slice_images_by_number(number_tiles)
-        self._ignore_tiles = []
-        self._just_image_call = True
+        validate_number_tiles(number_tiles)
+        img_mapper, ann_mapper = self.__slice_both(None, None, number_tiles=number_tiles)
+        if self.save_before_after_map:
+            save_before_after_map_csv(ann_mapper, self.ANN_DST)
+            save_before_after_map_csv(img_mapper, self.IMG_DST)
+
+    def __slice_both(self, tile_size, tile_overlap, number_tiles):
+        """
+        Private Method
+        """
+        ann_mapper = {}
+        img_no = 1
+        jobs = []
+
+        pairs = list(zip_longest(list_images(self.IMG_SRC), list_files(self.ANN_SRC, ('xml',))))
+        # Checked before anything is saved, the directories may have changed since `config_dirs`
+        for img_file, xml_file in pairs:
+            if (img_file is None or xml_file is None or
+                    os.path.splitext(os.path.basename(img_file))[0] != os.path.splitext(os.path.basename(xml_file))[0]):
+                raise ValueError('Images and annotation files do not match, {} is paired with {}. '
+                                 'Every image needs an annotation file of the same name.'.format(img_file, xml_file))
+
+        # One pass over the pairs of files, the annotations decide which tiles of the image to save.
+        # Tiles are planned from the size of the image itself, which the workers will cut,
+        # rather than from the size recorded in its annotation file, which may be stale.
+        for img_file, xml_file in pairs:
+            im_filename, file_tile_size, file_overlap, tile_ids, ignore = self.__slice_bbox_file(
+                xml_file, tile_size, tile_overlap, number_tiles, img_no, _peek_size(img_file))
+            jobs.append((img_file, self.IMG_DST, file_tile_size, file_overlap, ignore, img_no,
+                         self.png_compress_level))
+            img_no += len(tile_ids)
+            ann_mapper[im_filename] = tile_ids
+
+        print('Obtained {} annotation slices!'.format(img_no-1))
+        return self.__run_slice_jobs(jobs), ann_mapper
 
     def slice_images_by_size(self, tile_size, tile_overlap=0.0):
         """Slices each image in the source directory by specified size and overlap.
@@ -182,8 +251,6 @@ class Slicer(object):
         """
         validate_tile_size(tile_size)
         validate_overlap(tile_overlap)
-        if self._just_image_call:
-            self.ignore_empty_tiles = []
         mapper = self.__slice_images(tile_size, tile_overlap, number_tiles=-1)
         if self.save_before_after_map:
             save_before_after_map_csv(mapper, self.IMG_DST)
@@ -201,8 +268,6 @@ class Slicer(object):
         None
         """
         validate_number_tiles(number_tiles)
-        if self._just_image_call:
-            self.ignore_empty_tiles = []
         mapper = self.__slice_images(None, None, number_tiles=number_tiles)
         if self.save_before_after_map:
             save_before_after_map_csv(mapper, self.IMG_DST)
@@ -211,39 +276,50 @@ class Slicer(object):
         """
         Private Method
         """
-        mapper = {}
         img_no = 1
+        jobs = []
+
+        # Plan the work up front so that every file gets its own range of tile ids.
+        # `Image.open` only reads the header here, pixels are decoded by the workers.
+        for file in list_images(self.IMG_SRC):
+            img_size = _peek_size(file)
+            file_tile_size, file_overlap = self.__tile_params(img_size, tile_size, tile_overlap, number_tiles)
+            n_tiles = len(self.__get_tiles(img_size, file_tile_size, file_overlap))
+            jobs.append((file, self.IMG_DST, file_tile_size, file_overlap, frozenset(), img_no,
+                         self.png_compress_level))
+            img_no += n_tiles
+
+        return self.__run_slice_jobs(jobs)
+
+    def __run_slice_jobs(self, jobs):
+        """Runs `_slice_one_image` on every job, in worker processes if `n_workers` allows.
+        Private Method.
 
-        for file in sorted(glob.glob(self.IMG_SRC + os.sep + "*")):
-            file_name = file.split(os.sep)[-1].split('.')[0]
-            file_type = file.split(os.sep)[-1].split('.')[-1].lower()
-            if file_type.lower() not in IMG_FORMAT_LIST:
-                continue
-            im = Image.open(file)
-
-            if number_tiles > 0:
-                n_cols, n_rows = calc_columns_rows(number_tiles)
-                tile_w, tile_h = int(
-                    floor(im.size[0] / n_cols)), int(floor(im.size[1] / n_rows))
-                tile_size = (tile_w, tile_h)
-                tile_overlap = 0.0
-
-            tiles = self.__get_tiles(im.size, tile_size, tile_overlap)
-            new_ids = []
-            for tile in tiles:
-                new_im = im.crop(tile)
-                img_id_str = str('{:06d}'.format(img_no))
-                if len(self._ignore_tiles) != 0:
-                    if img_id_str in self._ignore_tiles:
-                        self._ignore_tiles.remove(img_id_str)
-                        continue
-                new_im.save(
-                    '{}{}{}.{}'.format(self.IMG_DST, os.sep, img_id_str, file_type))
-                new_ids.append(img_id_str)
-                img_no += 1
-            mapper[file_name] = new_ids
-
-        print('Obtained {} image slices!'.format(img_no-1))
+        Parameters
+        ----------
+        jobs : list
+            Arguments of `_slice_one_image` for each image, as tuples.
+
+        Returns
+        ----------
+        dict
+            Maps names of the source images to the ids of their saved tiles.
+        """
+        if self.n_workers == 1 or len(jobs) < 2:
+            results = [_slice_one_image(*job) for job in jobs]
+        else:
+            n_workers = self.n_workers or os.cpu_count() or 1
+            # The processes already keep the CPUs busy, share the saving threads between them
+            save_threads = max(1, SAVE_THREADS // n_workers)
+            jobs = [job + (save_threads,) for job in jobs]
+            # Hand out a few images at a time to cut down on inter-process round trips,
+            # while leaving enough chunks for the workers to balance the load
+            chunksize = max(1, len(jobs) // (4 * n_workers))
+            with ProcessPoolExecutor(max_workers=n_workers) as executor:
+                results = list(executor.map(_slice_one_image, *zip(*jobs), chunksize=chunksize))
+        mapper = dict(results)
+
+        print('Obtained {} image slices!'.format(sum(len(new_ids) for new_ids in mapper.values())))
         return mapper
 
     def slice_bboxes_by_size(self, tile_size, tile_overlap=0.0):
@@ -263,7 +339,6 @@ class Slicer(object):
         """
         validate_tile_size(tile_size)
         validate_overlap(tile_overlap)
-        self._ignore_tiles = []
         mapper = self.__slice_bboxes(tile_size, tile_overlap, number_tiles=-1)
         if self.save_before_after_map:
             save_before_after_map_csv(mapper, self.ANN_DST)
@@ -281,7 +356,6 @@ class Slicer(object):
         None
         """
         validate_number_tiles(number_tiles)
-        self._ignore_tiles = []
         mapper = self.__slice_bboxes(None, None, number_tiles=number_tiles)
         if self.save_before_after_map:
             save_before_after_map_csv(mapper, self.ANN_DST)
@@ -292,92 +366,79 @@ class Slicer(object):
         """
         img_no = 1
         mapper = {}
-        empty_count = 0
-
-        for xml_file in sorted(glob.glob(self.ANN_SRC + os.sep + '*.xml')):
-            root, objects = extract_from_xml(xml_file)
-            im_w, im_h = int(root.find('size')[0].text), int(
-                root.find('size')[1].text)
-            im_filename = os.path.splitext(root.find('filename').text)[0]
-            extn = os.path.splitext(root.find('filename').text)[1]
-            if number_tiles > 0:
-                n_cols, n_rows = calc_columns_rows(number_tiles)
-                tile_w = int(floor(im_w / n_cols))
-                tile_h = int(floor(im_h / n_rows))
-                tile_size = (tile_w, tile_h)
-                tile_overlap = 0.0
-            else:
-                tile_w, tile_h = tile_size
-            tiles = self.__get_tiles((im_w, im_h), tile_size, tile_overlap)
-            tile_ids = []
-
-            for tile in tiles:
-                img_no_str = '{:06d}'.format(img_no)
-                voc_writer = Writer('{}{}{}{}'.format(self.ANN_DST, os.sep, img_no_str, extn), tile_w, tile_h)
-                for obj in objects:
-                    obj_lbl = obj[-4:]
-                    points_info = which_points_lie(obj_lbl, tile)
-
-                    if points_info == Points.NONE:
-                        empty_count += 1
-                        continue
-
-                    elif points_info == Points.ALL:       # All points lie inside the tile
-                        new_lbl = (obj_lbl[0] - tile[0], obj_lbl[1] - tile[1],
-                                   obj_lbl[2] - tile[0], obj_lbl[3] - tile[1])
-
-                    elif not self.keep_partial_labels:    # Ignore partial labels based on configuration
-                        empty_count += 1
-                        continue
-
-                    elif points_info == Points.P1:
-                        new_lbl = (obj_lbl[0] - tile[0], obj_lbl[1] - tile[1],
-                                   tile_w, tile_h)
-
-                    elif points_info == Points.P2:
-                        new_lbl = (0, obj_lbl[1] - tile[1],
-                                   obj_lbl[2] - tile[0], tile_h)
-
-                    elif points_info == Points.P3:
-                        new_lbl = (obj_lbl[0] - tile[0], 0,
-                                   tile_w, obj_lbl[3] - tile[1])
-
-                    elif points_info == Points.P4:
-                        new_lbl = (0, 0, obj_lbl[2] - tile[0],
-                                   obj_lbl[3] - tile[1])
-
-                    elif points_info == Points.P1_P2:
-                        new_lbl = (obj_lbl[0] - tile[0], obj_lbl[1] - tile[1],
-                                   obj_lbl[2] - tile[0], tile_h)
-
-                    elif points_info == Points.P1_P3:
-                        new_lbl = (obj_lbl[0] - tile[0], obj_lbl[1] - tile[1],
-                                   tile_w, obj_lbl[3] - tile[1])
-
-                    elif points_info == Points.P2_P4:
-                        new_lbl = (0, obj_lbl[1] - tile[1],
-                                   obj_lbl[2] - tile[0], obj_lbl[3] - tile[1])
-
-                    elif points_info == Points.P3_P4:
-                        new_lbl = (obj_lbl[0] - tile[0], 0,
-                                   obj_lbl[2] - tile[0], obj_lbl[3] - tile[1])
-
-                    voc_writer.addObject(obj[0], new_lbl[0], new_lbl[1], new_lbl[2], new_lbl[3],
-                                         obj[1], obj[2], obj[3])
-                if self.ignore_empty_tiles and (empty_count == len(objects)):
-                    self._ignore_tiles.append(img_no_str)
-                else:
-                    voc_writer.save(
-                        '{}{}{}.xml'.format(self.ANN_DST, os.sep, img_no_str))
-                    tile_ids.append(img_no_str)
-                    img_no += 1
-                empty_count = 0
+
+        for xml_file in list_files(self.ANN_SRC, ('xml',)):
+            im_filename, _, _, tile_ids, _ = self.__slice_bbox_file(
+                xml_file, tile_size, tile_overlap, number_tiles, img_no)
+            img_no += len(tile_ids)
             mapper[im_filename] = tile_ids
 
         print('Obtained {} annotation slices!'.format(img_no-1))
         return mapper
 
-    def resize_by_size(self, new_size, resample=0):
+    def __slice_bbox_file(self, xml_file, tile_size, tile_overlap, number_tiles, img_no, img_size=None):
+        """Slices the box annotations of a single XML file and saves them.
+        Private Method.
+
+        Parameters
+        ----------
+        xml_file : str
+            /path/to/xml/file
+        tile_size : tuple
+            Size of each tile in pixels, as a 2-tuple: (width, height).
+        tile_overlap: float
+            Percentage of tile overlap between two consecutive strides.
+        number_tiles : int
+            The number of tiles an image needs to be sliced into, `-1` to slice by size.
+        img_no : int
+            Id of the first saved tile, the following ones are numbered consecutively.
+        img_size : tuple, optional
+            Size of the annotated image in pixels, as a 2-tuple: (width, height).
+            By default, the size recorded in `xml_file` is used.
+
+        Returns
+        ----------
+        str, tuple, float, list, frozenset
+            str is the name of the annotated image.
+            tuple and float are the tile size and overlap used for this image.
+            list contains ids of the saved tiles.
+            frozenset contains indices of the tiles that were left out for being empty.
+        """
+        im_filename, im_w, im_h, objects, boxes = extract_from_xml(xml_file)
+        im_filename, extn = os.path.splitext(im_filename)
+        if img_size is not None:
+            im_w, im_h = img_size
+        tile_size, tile_overlap = self.__tile_params((im_w, im_h), tile_size, tile_overlap, number_tiles)
+        tile_w, tile_h = tile_size
+        tiles = self.__get_tiles((im_w, im_h), tile_size, tile_overlap)
+        tile_ids = []
+        ignore = []
+
+        # Only clip the (tile, box) pairs that can overlap at all
+        pair_tiles, pair_boxes = find_tile_overlaps((im_w, im_h), tile_size, tile_overlap, boxes)
+        new_lbls, keep = clip_boxes(tiles[pair_tiles], boxes[pair_boxes], self.keep_partial_labels)
+        pair_tiles, pair_boxes, new_lbls = pair_tiles[keep], pair_boxes[keep].tolist(), new_lbls[keep].tolist()
+        # Pairs are sorted by tile, pairs of tile `t` are at `bounds[t]:bounds[t+1]`
+        bounds = np.searchsorted(pair_tiles, np.arange(len(tiles) + 1)).tolist()
+        header = make_voc_header(self.ANN_DST, (tile_w, tile_h))
+        ann_prefix = self.ANN_DST + os.sep
+
+        for t_idx in range(len(tiles)):
+            img_no_str = '{:06d}'.format(img_no)
+            lo, hi = bounds[t_idx], bounds[t_idx + 1]
+            if self.ignore_empty_tiles and lo == hi:
+                ignore.append(t_idx)
+                continue
+            save_voc_xml(ann_prefix + img_no_str + '.xml',
+                         ann_prefix + img_no_str + extn,
+                         (tile_w, tile_h),
+                         [objects[o_idx] for o_idx in pair_boxes[lo:hi]], new_lbls[lo:hi],
+                         header=header)
+            tile_ids.append(img_no_str)
+            img_no += 1
+        return im_filename, tile_size, tile_overlap, tile_ids, frozenset(ignore)
+
+    def resize_by_size(self, new_size, resample=0, executor=None):
         """Resizes both images and box annotations in source directories to specified size `new_size`.
 
         Parameters
@@ -391,15 +452,25 @@ class Slicer(object):
             `1` for LANCZOS/ANTIALIAS (a high-quality downsampling filter)
             `2` for BILINEAR/LINEAR (linear interpolation)
             `3` for BICUBIC/CUBIC (cubic spline interpolation)
+        executor : concurrent.futures.Executor, optional
+            Executor to resize the images with, e.g. a `ProcessPoolExecutor`
+            or one spreading the work over several machines.
+            By default, images are resized in `n_workers` threads.
 
         Returns
         ----------
         None
+
+        Raises
+        ----------
+        ValueError
+            If `resample` is not one of the codes above.
         """
-        self.resize_images_by_size(new_size, resample)
-        self.resize_bboxes_by_size(new_size)
+        validate_new_size(new_size)
+        resample = _resample_filter(resample)
+        self.__resize_pairs(new_size, resample, None, executor)
 
-    def resize_images_by_size(self, new_size, resample=0):
+    def resize_images_by_size(self, new_size, resample=0, executor=None):
         """Resizes images in the image source directory to specified size `new_size`.
 
         Parameters
@@ -413,15 +484,25 @@ class Slicer(object):
             `1` for LANCZOS/ANTIALIAS (a high-quality downsampling filter)
             `2` for BILINEAR/LINEAR (linear interpolation)
             `3` for BICUBIC/CUBIC (cubic spline interpolation)
+        executor : concurrent.futures.Executor, optional
+            Executor to resize the images with, e.g. a `ProcessPoolExecutor`
+            or one spreading the work over several machines.
+            By default, images are resized in `n_workers` threads.
 
         Returns
         ----------
         None
+
+        Raises
+        ----------
+        ValueError
+            If `resample` is not one of the codes above.
         """
         validate_new_size(new_size)
-        self.__resize_images(new_size, resample, None)
+        resample = _resample_filter(resample)
+        self.__resize_images(new_size, resample, None, executor)
 
-    def resize_by_factor(self, resize_factor, resample=0):
+    def resize_by_factor(self, resize_factor, resample=0, executor=None):
         """Resizes both images and annotations in the source directories by a scaling/resizing factor.
 
         Parameters
@@ -435,16 +516,25 @@ class Slicer(object):
             `1` for LANCZOS/ANTIALIAS (a high-quality downsampling filter)
             `2` for BILINEAR/LINEAR (linear interpolation)
             `3` for BICUBIC/CUBIC (cubic spline interpolation)
+        executor : concurrent.futures.Executor, optional
+            Executor to resize the images with, e.g. a `ProcessPoolExecutor`
+            or one spreading the work over several machines.
+            By default, images are resized in `n_workers` threads.
 
         Returns
         ----------
         None
+
+        Raises
+        ----------
+        ValueError
+            If `resample` is not one of the codes above.
         """
         validate_resize_factor(resize_factor)
-        self.resize_images_by_factor(resize_factor, resample)
-        self.resize_bboxes_by_factor(resize_factor)
+        resample = _resample_filter(resample)
+        self.__resize_pairs(None, resample, resize_factor, executor)
 
-    def resize_images_by_factor(self, resize_factor, resample=0):
+    def resize_images_by_factor(self, resize_factor, resample=0, executor=None):
         """Resizes images in the image source directory by a scaling/resizing factor.
 
         Parameters
@@ -458,31 +548,82 @@ class Slicer(object):
             `1` for LANCZOS/ANTIALIAS (a high-quality downsampling filter)
             `2` for BILINEAR/LINEAR (linear interpolation)
             `3` for BICUBIC/CUBIC (cubic spline interpolation)
+        executor : concurrent.futures.Executor, optional
+            Executor to resize the images with, e.g. a `ProcessPoolExecutor`
+            or one spreading the work over several machines.
+            By default, images are resized in `n_workers` threads.
 
         Returns
         ----------
         None
+
+        Raises
+        ----------
+        ValueError
+            If `resample` is not one of the codes above.
         """
         validate_resize_factor(resize_factor)
-        self.__resize_images(None, resample, resize_factor)
+        resample = _resample_filter(resample)
+        self.__resize_images(None, resample, resize_factor, executor)
 
-    def __resize_images(self, new_size, resample, resize_factor):
+    def __resize_images(self, new_size, resample, resize_factor, executor=None):
         """Private Method
         """
-        for file in sorted(glob.glob(self.IMG_SRC + os.sep + "*")):
-            file_name = file.split(os.sep)[-1].split('.')[0]
-            file_type = file.split(os.sep)[-1].split('.')[-1].lower()
-            if file_type not in IMG_FORMAT_LIST:
-                continue
-            im = Image.open(file)
-            if resize_factor is not None:
-                new_size = [0, 0]
-                new_size[0] = int(im.size[0] * resize_factor)
-                new_size[1] = int(im.size[1] * resize_factor)
-                new_size = tuple(new_size)
+        jobs = [(file, self.IMG_DST, new_size, resample, resize_factor, self.png_compress_level)
+                for file in list_images(self.IMG_SRC)]
+        self.__run_resize_jobs(_resize_one_image, jobs, executor)
+
+    def __resize_pairs(self, new_size, resample, resize_factor, executor=None):
+        """Private Method
+        """
+        # One pass over the pairs of files, boxes are scaled along with their image.
+        # Files are paired by name, images or annotations without a counterpart are resized alone.
+        xml_files = {os.path.splitext(os.path.basename(file))[0]: file
+                     for file in list_files(self.ANN_SRC, ('xml',))}
+        jobs, lone_jobs = [], []
+        for img_file in list_images(self.IMG_SRC):
+            xml_file = xml_files.pop(os.path.splitext(os.path.basename(img_file))[0], None)
+            if xml_file is None:
+                lone_jobs.append((img_file, self.IMG_DST, new_size, resample, resize_factor,
+                                  self.png_compress_level))
+            else:
+                jobs.append((img_file, xml_file, self.IMG_DST, self.ANN_DST, new_size, resample, resize_factor,
+                             self.png_compress_level))
+        self.__run_resize_jobs(_resize_one_pair, jobs, executor)
+        self.__run_resize_jobs(_resize_one_image, lone_jobs, executor)
+        for xml_file in xml_files.values():
+            _resize_one_annotation(xml_file, self.ANN_DST, new_size, resize_factor)
+
+    def __run_resize_jobs(self, func, jobs, executor=None):
+        """Runs `func` on every job, on `executor` or else in `n_workers` threads.
+        Private Method.
 
-            new_im = im.resize(size=new_size, resample=resample)
-            new_im.save('{}{}{}.{}'.format(self.IMG_DST, os.sep, file_name, file_type))
+        Parameters
+        ----------
+        func : function
+            Function to run, defined at module level so that any executor can send it to its workers.
+        jobs : list
+            Arguments of `func` for each call, as tuples.
+        executor : concurrent.futures.Executor, optional
+            Executor to submit the calls to.
+
+        Returns
+        ----------
+        None
+        """
+        if executor is not None:
+            futures = [executor.submit(func, *job) for job in jobs]
+            for future in futures:
+                # Re-raises any error hit in a worker
+                future.result()
+        elif self.n_workers == 1 or len(jobs) < 2:
+            for job in jobs:
+                func(*job)
+        else:
+            # Pillow releases the GIL while decoding, resizing and encoding, threads are enough
+            with ThreadPoolExecutor(max_workers=self.n_workers or os.cpu_count() or 1) as executor:
+                # Consuming the results re-raises any error hit in a worker
+                list(executor.map(func, *zip(*jobs)))
 
     def resize_bboxes_by_size(self, new_size):
         """Resizes bounding box annotations in the source directory to specified size `new_size`.
@@ -517,35 +658,21 @@ class Slicer(object):
     def __resize_bboxes(self, new_size, resize_factor):
         """Private Method
         """
-        for xml_file in sorted(glob.glob(self.ANN_SRC + os.sep + '*.xml')):
-            root, objects = extract_from_xml(xml_file)
-            im_w, im_h = int(root.find('size')[0].text), int(
-                root.find('size')[1].text)
-            im_filename = os.path.splitext(root.find('filename').text)[0]
-            an_filename = xml_file.split(os.sep)[-1].split('.')[0]
-            extn = os.path.splitext(root.find('filename').text)[1]
-            if resize_factor is None:
-                w_scale, h_scale = new_size[0]/im_w, new_size[1]/im_h
-            else:
-                w_scale, h_scale = resize_factor, resize_factor
-                new_size = [0, 0]
-                new_size[0], new_size[1] = int(
-                    im_w * w_scale), int(im_h * h_scale)
-                new_size = tuple(new_size)
-
-            voc_writer = Writer(
-                '{}{}{}{}'.format(self.ANN_DST, os.sep, im_filename, extn), new_size[0], new_size[1])
-
-            for obj in objects:
-                obj_lbl = list(obj[-4:])
-                obj_lbl[0] = int(obj_lbl[0] * w_scale)
-                obj_lbl[1] = int(obj_lbl[1] * h_scale)
-                obj_lbl[2] = int(obj_lbl[2] * w_scale)
-                obj_lbl[3] = int(obj_lbl[3] * h_scale)
-
-                voc_writer.addObject(obj[0], obj_lbl[0], obj_lbl[1], obj_lbl[2], obj_lbl[3],
-                                     obj[1], obj[2], obj[3])
-            voc_writer.save('{}{}{}.xml'.format(self.ANN_DST, os.sep, an_filename))
+        # Boxes are scaled from the size recorded in their annotation files, images may
+        # have been resized already. Only image headers are read to warn about stale sizes.
+        images = {}
+        if os.path.isdir(self.IMG_SRC):
+            images = {os.path.splitext(os.path.basename(file))[0]: file for file in list_images(self.IMG_SRC)}
+        for xml_file in list_files(self.ANN_SRC, ('xml',)):
+            img_file = images.get(os.path.splitext(os.path.basename(xml_file))[0])
+            actual_size = None
+            if img_file is not None:
+                try:
+                    actual_size = _peek_size(img_file)
+                except OSError:
+                    # Only the size check is lost for an unreadable image
+                    pass
+            _resize_one_annotation(xml_file, self.ANN_DST, new_size, resize_factor, actual_size=actual_size)
 
     def visualize_sliced_random(self, map_dir=None):
         """Picks an image randomly and visualizes unsliced and sliced images using `matplotlib`.
@@ -574,7 +701,15 @@ class Slicer(object):
             read_csv = csv.reader(src_map, delimiter=',')
             # Skip the header
             next(read_csv, None)
-            mapping = random.choice(list(read_csv))
+            # Reservoir sampling, picks a row uniformly without loading the whole file
+            n_rows = 0
+            for row in read_csv:
+                # Rows are `old_name,new_name_1,new_name_2,...`, skip images without any tiles
+                if len(row) < 2:
+                    continue
+                n_rows += 1
+                if random.randrange(n_rows) == 0:
+                    mapping = row
             src_file = mapping[0]
             tile_files = mapping[1:]
 
@@ -593,8 +728,8 @@ class Slicer(object):
         None
             However, displays the final plots.
         """
-        im_file = random.choice(list(glob.glob('{}{}*'.format(self.IMG_SRC, os.sep))))
-        file_name = im_file.split(os.sep)[-1].split('.')[0]
+        im_file = random.choice(list_images(self.IMG_SRC))
+        file_name = os.path.splitext(os.path.basename(im_file))[0]
 
         plot_image_boxes(self.IMG_SRC, self.ANN_SRC, file_name)
         plot_image_boxes(self.IMG_DST, self.ANN_DST, file_name)
@@ -602,7 +737,7 @@ class Slicer(object):
 
 class Points(Enum):
     """An Enum to hold info of points of a bounding box or a tile.
-    Used by the method `which_points_lie` and a private method in `Slicer` class. 
+    Used by the method `which_points_lie`. 
     See `which_points_lie` method for more details.
 
     Example
@@ -647,44 +782,340 @@ def which_points_lie(label, tile):
     # 0,1 -- 2,1
     # |        |
     # 0,3 -- 2,3
-    points = [False, False, False, False]
-
-    if (tile[0] <= label[0] and tile[2] >= label[0]):
-        if (tile[1] <= label[1] and tile[3] >= label[1]):
-            points[0] = True
-        if (tile[1] <= label[3] and tile[3] >= label[3]):
-            points[2] = True
-
-    if (tile[0] <= label[2] and tile[2] >= label[2]):
-        if (tile[1] <= label[1] and tile[3] >= label[1]):
-            points[1] = True
-        if (tile[1] <= label[3] and tile[3] >= label[3]):
-            points[3] = True
-
-    if sum(points) == 0:
-        return Points.NONE
-    elif sum(points) == 4:
-        return Points.ALL
-
-    elif points[0]:
-        if points[1]:
-            return Points.P1_P2
-        elif points[2]:
-            return Points.P1_P3
-        else:
-            return Points.P1
+    in_x1 = tile[0] <= label[0] <= tile[2]
+    in_x2 = tile[0] <= label[2] <= tile[2]
+    in_y1 = tile[1] <= label[1] <= tile[3]
+    in_y3 = tile[1] <= label[3] <= tile[3]
+    # One bit per point, P1 being the lowest
+    code = ((in_x1 and in_y1) | (in_x2 and in_y1) << 1 |
+            (in_x1 and in_y3) << 2 | (in_x2 and in_y3) << 3)
+    return _POINTS_BY_CODE[code]
+
+
+# `which_points_lie` result for each combination of points lying on the tile.
+# Points that can't be the only ones on a tile together (e.g. P1 and P4) resolve
+# to the first matching case, P1 before P2 before P3.
+_POINTS_BY_CODE = (
+    Points.NONE, Points.P1, Points.P2, Points.P1_P2,
+    Points.P3, Points.P1_P3, Points.P2, Points.P1_P2,
+    Points.P4, Points.P1, Points.P2_P4, Points.P1_P2,
+    Points.P3_P4, Points.P1_P3, Points.P2_P4, Points.ALL,
+)
+
+
+def _peek_size(file):
+    """Reads the size of an image from its header, without decoding the pixels.
 
-    elif points[1]:
-        if points[3]:
-            return Points.P2_P4
-        else:
-            return Points.P2
+    Parameters
+    ----------
+    file : str
+        /path/to/image/file
+
+    Returns
+    ----------
+    tuple
+        Size of the image in pixels, as a 2-tuple: (width, height).
+    """
+    with Image.open(file) as im:
+        return im.size
+
+
+# Resampling filters accepted by the resizing methods, by their documented codes.
+# `Image.Resampling` only exists since Pillow 9.1, older ones keep the constants on `Image`.
+_FILTERS = getattr(Image, 'Resampling', Image)
+_RESAMPLE = {
+    0: _FILTERS.NEAREST,
+    1: _FILTERS.LANCZOS,
+    2: _FILTERS.BILINEAR,
+    3: _FILTERS.BICUBIC,
+}
+
+
+def _resample_filter(resample):
+    """Resolves a resampling code into the Pillow filter it stands for.
+
+    Parameters
+    ----------
+    resample : int
+        `0` for NEAREST, `1` for LANCZOS, `2` for BILINEAR or `3` for BICUBIC.
+
+    Returns
+    ----------
+    PIL.Image.Resampling
+        The resampling filter to pass to `PIL.Image.resize()`.
+
+    Raises
+    ----------
+    ValueError
+        If `resample` is not one of the codes above.
+    """
+    try:
+        return _RESAMPLE[resample]
+    except (KeyError, TypeError):
+        raise ValueError(
+            'Resample should be one of {}. The value provided was {}'.format(sorted(_RESAMPLE), resample)) from None
 
-    elif points[2]:
-        if points[3]:
-            return Points.P3_P4
-        else:
-            return Points.P3
 
+def _save_params(file_type, png_compress_level):
+    """Returns the keyword arguments of `Image.save` for images of type `file_type`.
+
+    Parameters
+    ----------
+    file_type : str
+        Extension of the image files, in lower case.
+    png_compress_level : int
+        ZLIB compression level of PNG files.
+
+    Returns
+    ----------
+    dict
+    """
+    if file_type == 'png':
+        return {'compress_level': png_compress_level}
+    # Pillow's JPEG defaults already skip the slow optimize and progressive passes
+    return {}
+
+
+def _slice_one_image(file, img_dst, tile_size, tile_overlap, ignore, img_no, png_compress_level=6,
+                     save_threads=SAVE_THREADS):
+    """Slices a single image and saves its tiles. 
+    Runs in a worker process of `Slicer`.
+
+    Parameters
+    ----------
+    file : str
+        /path/to/image/file
+    img_dst : str
+        /path/to/images/destination/directory
+    tile_size : tuple
+        Size of each tile in pixels, as a 2-tuple: (width, height).
+    tile_overlap: float
+        Percentage of tile overlap between two consecutive strides.
+    ignore : frozenset
+        Indices of the tiles of this image that should not be saved.
+    img_no : int
+        Id of the first saved tile, the following ones are numbered consecutively.
+    png_compress_level : int, optional
+        ZLIB compression level of PNG tiles.
+        Default value is `6`.
+    save_threads : int, optional
+        Number of threads saving the tiles.
+        Default value is `SAVE_THREADS`.
+
+    Returns
+    ----------
+    str, list
+        str is the name of the source image.
+        list contains ids of the saved tiles.
+    """
+    file_name, file_type = os.path.splitext(os.path.basename(file))
+    file_type = file_type[1:].lower()
+    save_params = _save_params(file_type, png_compress_level)
+    with Image.open(file) as im:
+        # Decode the image once and cut every tile out of the same pixel array
+        arr = np.asarray(im)
+        mode, img_size, info = im.mode, im.size, im.info
+        palette = im.getpalette() if mode in ('P', 'PA') else None
+    raw_mode = '1;8' if mode == '1' else mode
+    dst_prefix, dst_suffix = img_dst + os.sep, '.' + file_type
+    new_ids = []
+    futures = deque()
+    # PIL releases the GIL while encoding, so saving in threads overlaps
+    # encoding and writing a tile with cutting out the next ones
+    with ThreadPoolExecutor(max_workers=save_threads) as executor:
+        for idx, (x1, y1, x2, y2) in enumerate(get_tiles(img_size, tile_size, tile_overlap).tolist()):
+            if idx in ignore:
+                continue
+            new_im = Image.frombuffer(mode, (x2 - x1, y2 - y1), np.ascontiguousarray(arr[y1:y2, x1:x2]),
+                                      'raw', raw_mode, 0, 1)
+            if palette is not None:
+                new_im.putpalette(palette)
+            new_im.info = info.copy()
+            img_id_str = '{:06d}'.format(img_no)
+            futures.append(executor.submit(new_im.save, dst_prefix + img_id_str + dst_suffix, **save_params))
+            new_ids.append(img_id_str)
+            img_no += 1
+            # Every pending tile holds a copy of its pixels, wait for the oldest ones
+            # so that memory use doesn't grow with the number of tiles
+            while len(futures) > 2 * save_threads:
+                # Re-raises any error hit while saving
+                futures.popleft().result()
+    for future in futures:
+        future.result()
+    return file_name, new_ids
+
+
+def _resize_one_image(file, img_dst, new_size, resample, resize_factor, png_compress_level=6):
+    """Resizes a single image and saves it under the same name.
+    Runs in a worker thread of `Slicer`.
+
+    Parameters
+    ----------
+    file : str
+        /path/to/image/file
+    img_dst : str
+        /path/to/images/destination/directory
+    new_size : tuple
+        The requested size in pixels, as a 2-tuple: (width, height).
+        Ignored when `resize_factor` is given.
+    resample : int
+        Resampling filter, same as the one used in PIL.Image.resize() function.
+    resize_factor : float
+        A factor by which the image should be scaled, or `None` to resize it to `new_size`.
+    png_compress_level : int, optional
+        ZLIB compression level of PNG images.
+        Default value is `6`.
+
+    Returns
+    ----------
+    tuple
+        Size of the original image in pixels, as a 2-tuple: (width, height).
+    """
+    file_name, file_type = os.path.splitext(os.path.basename(file))
+    file_type = file_type[1:].lower()
+    with Image.open(file) as im:
+        img_size = im.size
+        if resize_factor is not None:
+            new_size = (int(img_size[0] * resize_factor), int(img_size[1] * resize_factor))
+
+        if min(new_size) > 0 and resample != _FILTERS.NEAREST:
+            # Lets JPEGs decode straight at 1/2, 1/4 or 1/8 scale when that is still
+            # at least `new_size`, other formats are decoded as usual. Left out for NEAREST,
+            # which should pick pixels of the original rather than of a DCT-scaled image.
+            im.draft(im.mode, new_size)
+        # Shrinks by whole factors with a cheap box filter first, down to at least twice `new_size`,
+        # as `Image.thumbnail` does. Unlike it, keeps the exact size and aspect ratio asked for.
+        new_im = im.resize(size=new_size, resample=resample, reducing_gap=2.0)
+    _save_replacing(new_im, os.path.join(img_dst, '{}.{}'.format(file_name, file_type)),
+                    **_save_params(file_type, png_compress_level))
+    return img_size
+
+
+def _save_replacing(im, path, **params):
+    """Saves an image through a temporary file, so `path` never holds a partly written image.
+
+    Resized images keep the names of their sources. When the destination directory
+    is the source one, an interrupted save would otherwise destroy the original image.
+
+    Parameters
+    ----------
+    im : PIL.Image.Image
+        Image to save.
+    path : str
+        /path/to/image/file, its extension decides the format.
+    **params
+        Keyword arguments of `Image.save`.
+
+    Returns
+    ----------
+    None
+    """
+    img_format = Image.registered_extensions().get(os.path.splitext(path)[1].lower())
+    _write_replacing(path, lambda tmp_path: im.save(tmp_path, format=img_format, **params))
+
+
+def _write_replacing(path, write):
+    """Writes a file through a temporary one, which then replaces `path` in one step.
+
+    Parameters
+    ----------
+    path : str
+        /path/to/file
+    write : function
+        Writes the file to the path it is called with.
+
+    Returns
+    ----------
+    None
+    """
+    tmp_path = path + '.part'
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _resize_one_annotation(xml_file, ann_dst, new_size, resize_factor, img_size=None, actual_size=None):
+    """Resizes the bounding boxes of a single PASCAL VOC file and saves it under the same name.
+
+    Parameters
+    ----------
+    xml_file : str
+        /path/to/xml/file
+    ann_dst : str
+        /path/to/annotations/destination/directory
+    new_size : tuple
+        The requested size in pixels, as a 2-tuple: (width, height).
+        Ignored when `resize_factor` is given.
+    resize_factor : float
+        A factor by which the boxes should be scaled, or `None` to scale them to `new_size`.
+    img_size : tuple, optional
+        Size of the original image in pixels, as a 2-tuple: (width, height).
+        By default, it is read from the file.
+    actual_size : tuple, optional
+        Size of the image as found on disk, as a 2-tuple: (width, height).
+        A warning is issued when it is neither the original size nor the resized one.
+
+    Returns
+    ----------
+    None
+    """
+    im_filename, im_w, im_h, objects, boxes = extract_from_xml(xml_file)
+    im_filename, extn = os.path.splitext(im_filename)
+    an_filename = os.path.splitext(os.path.basename(xml_file))[0]
+    if img_size is not None:
+        im_w, im_h = img_size
+    if resize_factor is None:
+        w_scale, h_scale = new_size[0]/im_w, new_size[1]/im_h
     else:
-        return Points.P4
+        w_scale, h_scale = resize_factor, resize_factor
+        new_size = (int(im_w * w_scale), int(im_h * h_scale))
+    if actual_size is not None and tuple(actual_size) not in ((im_w, im_h), tuple(new_size)):
+        warnings.warn('{} records an image size of {}x{} but the image is {}x{}, '
+                      'boxes are scaled from the recorded size.'.format(xml_file, im_w, im_h, *actual_size))
+
+    # Float64 and truncation towards zero, as int() on Python floats
+    new_boxes = (boxes * np.array([w_scale, h_scale, w_scale, h_scale])).astype(np.int32)
+    img_path = os.path.join(ann_dst, im_filename + extn)
+    # Like images, resized annotation files may replace their sources
+    _write_replacing(os.path.join(ann_dst, an_filename + '.xml'),
+                     lambda tmp_path: save_voc_xml(tmp_path, img_path, new_size, objects, new_boxes))
+
+
+def _resize_one_pair(img_file, xml_file, img_dst, ann_dst, new_size, resample, resize_factor,
+                     png_compress_level=6):
+    """Resizes an image and its bounding boxes, and saves both under the same names.
+    Runs in a worker thread of `Slicer`.
+
+    Boxes are scaled according to the actual size of the image.
+
+    Parameters
+    ----------
+    img_file : str
+        /path/to/image/file
+    xml_file : str
+        /path/to/xml/file
+    img_dst : str
+        /path/to/images/destination/directory
+    ann_dst : str
+        /path/to/annotations/destination/directory
+    new_size : tuple
+        The requested size in pixels, as a 2-tuple: (width, height).
+        Ignored when `resize_factor` is given.
+    resample : int
+        Resampling filter, same as the one used in PIL.Image.resize() function.
+    resize_factor : float
+        A factor by which the image and the boxes should be scaled, or `None` to resize them to `new_size`.
+    png_compress_level : int, optional
+        ZLIB compression level of PNG images.
+        Default value is `6`.
+
+    Returns
+    ----------
+    None
+    """
+    img_size = _resize_one_image(img_file, img_dst, new_size, resample, resize_factor, png_compress_level)
+    _resize_one_annotation(xml_file, ann_dst, new_size, resize_factor, img_size)
@@ -1,4 +1,4 @@
-from distutils.core import setup
+from setuptools import setup
 setup(
   name = 'image_bbox_slicer',
   packages = ['image_bbox_slicer'],   
@@ -10,11 +10,11 @@ setup(
   url = 'https://github.com/acl21/image_bbox_slicer/',
   download_url = 'https://github.com/acl21/image_bbox_slicer/archive/refs/tags/v0.3.tar.gz',
   keywords = ['Image Slicer', 'Bounding Box Annotations Slicer', 'Slicer', 'PASCAL VOC Slicer', 'Object Detection', 'Resize Images', 'Resize Bounding Box Annotations'],  
+  python_requires='>=3.7',
   install_requires=[            
-		'Pillow',
+		'Pillow>=7.0',
 		'numpy',
-		'matplotlib',
-		'pascal-voc-writer'
+		'matplotlib'
 		],
   classifiers=[
     'Development Status :: 4 - Beta',      
@@ -22,9 +22,11 @@ setup(
     'Topic :: Software Development :: Build Tools',
     'License :: OSI Approved :: MIT License',   
     'Programming Language :: Python :: 3',      
-    'Programming Language :: Python :: 3.4',
-    'Programming Language :: Python :: 3.5',
-    'Programming Language :: Python :: 3.6',
     'Programming Language :: Python :: 3.7',
+    'Programming Language :: Python :: 3.8',
+    'Programming Language :: Python :: 3.9',
+    'Programming Language :: Python :: 3.10',
+    'Programming Language :: Python :: 3.11',
+    'Programming Language :: Python :: 3.12',
   ],
 )